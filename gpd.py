@@ -1,14 +1,73 @@
+import asyncio
 import click
 import configparser
+import fcntl
 import hashlib
+import hmac
+import http.client
+import importlib.util
 import logging
+import mmap
 import multiprocessing
+import json
 import os
+import queue
+import random
+import re
+import requests
+import select
+import shutil
+import socket
+import struct
 import subprocess as sp
 import sys
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 from functools import partial
-from xml.etree import cElementTree as ET
+from http.cookiejar import MozillaCookieJar
+from urllib.parse import urlsplit
+from xml.etree import ElementTree as ET
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+try:
+    from lxml import etree as lxml_etree
+except ImportError:
+    lxml_etree = None
+
+
+JGI_URL = "http://genome.jgi.doe.gov"
+JGI_SIGNON_URL = "https://signon.jgi.doe.gov/signon/create"
+# `--parallel` arrived in 7.66, the `exitcode` write-out variable in 7.75
+CURL_PARALLEL_VERSION = (7, 75)
+CURL_CONFIG_ENTRY = "url = {url}\noutput = {output}\n"
+MD5_BUFFER_SIZE = 1 << 22
+SPLICE_SIZE = 1 << 20
+# columns always present in the output of `links_from_xml`
+LINK_COLUMNS = ("filename", "url", "md5", "sizeInBytes", "parent_folder")
+# stands in for an md5 the XML lists but that isn't valid hex; never matches
+INVALID_MD5 = b"invalid"
+# stands in for the local md5 of a file whose download ran out of retries
+DOWNLOAD_FAILED = b"failed"
+VERIFIED_CACHE = ".gpd-verified.json"
+# longest wait, in seconds, between retries of a failed `curl`
+MAX_BACKOFF = 60
+# seconds to wait for a connection and for data on an open connection
+CONNECT_TIMEOUT = 60
+READ_TIMEOUT = 300
+# `file` children of a `folder`, evaluated by libxml2 when lxml is available
+FOLDER_FILES = lxml_etree.XPath("./file") if lxml_etree is not None else None
+# MD5P8 deals 64 byte blocks round-robin into 8 independent MD5 streams
+MD5P8_STREAMS = 8
+MD5P8_BLOCK = 64
+MD5P8_ROWS = 8192
+# one unpack gathers a single stream's blocks across a whole window
+MD5P8_GATHER = struct.Struct(
+    ("%ds%dx" % (MD5P8_BLOCK, (MD5P8_STREAMS - 1) * MD5P8_BLOCK)) *
+    (MD5P8_ROWS - 1) + "%ds" % MD5P8_BLOCK)
 
 
 def read_config(config=None):
@@ -17,7 +76,7 @@ def read_config(config=None):
     else:
         cfg = os.path.abspath(config)
     if not os.path.exists(cfg):
-        logging.critical("Config file not present. Checked: %s" % cfg)
+        logging.critical("Config file not present. Checked: %s", cfg)
         sys.exit(1)
     parser = configparser.RawConfigParser()
     parser.read([cfg])
@@ -37,7 +96,7 @@ def read_config(config=None):
     if jgi_present and username_present and password_present:
         return rv
     else:
-        logging.critical("The configuration file (%s) is improperly formatted. See --help." % cfg)
+        logging.critical("The configuration file (%s) is improperly formatted. See --help.", cfg)
         sys.exit(1)
 
 
@@ -55,22 +114,28 @@ def set_cookie(username, password, output):
     Note:
         This method will exit with `1` if login appears to fail.
     """
-    cookie = "{output}/jgi-cookies".format(output=output)
-    cmd = ("curl 'https://signon.jgi.doe.gov/signon/create' --data-urlencode "
-           "'login={username}' --data-urlencode 'password={password}' "
-           "-c {cookie} -s > {null}").format(username=username,
-           password=password, cookie=cookie, null=os.devnull)
-    logging.debug(cmd)
-    sp.check_call(cmd, shell=True)
-    logged_in = False
-    with open(cookie) as fh:
-        for line in fh:
-            if "jgi_session" and "TRUE" in line:
-                logged_in = True
-                logging.info("Successfully signed into JGI.")
-    if not logged_in:
-        logging.critical("Login failed.")
+    cookie = os.path.join(output, "jgi-cookies")
+    session = requests.Session()
+    try:
+        resp = session.post(JGI_SIGNON_URL,
+                            data={"login": username, "password": password},
+                            timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+    except requests.RequestException as e:
+        logging.critical("Login failed: %s", e)
         sys.exit(1)
+    if "jgi_session" not in session.cookies:
+        logging.critical("Login failed (HTTP %d).", resp.status_code)
+        sys.exit(1)
+    logging.info("Successfully signed into JGI.")
+    # the download engines read the session from a Netscape format cookie jar
+    jar = MozillaCookieJar(cookie)
+    for c in session.cookies:
+        if c.expires is None:
+            # `curl` expects 0 rather than an empty field for session cookies
+            c.expires = 0
+        jar.set_cookie(c)
+    logging.debug("Writing session cookie to %s", cookie)
+    jar.save(ignore_discard=True, ignore_expires=True)
     return cookie
 
 
@@ -82,128 +147,764 @@ def links_from_xml(xml):
         xml (string): xml file path
 
     Returns:
-        list of dicts representing each individual file
+        dict of attribute name to a list holding that attribute for each
+        individual file; every list has one entry per file and attributes
+        missing from a file are ''; md5s are decoded to raw digest bytes, or
+        INVALID_MD5 when malformed
 
     >>> d = links_from_xml('get-directory.xml')
-    >>> d[0].keys()
-    dict_keys(['md5', 'parent_folder', 'url', 'timestamp', 'sizeInBytes', 'fastq_format', 'rta_version', 'quality_score_type', 'library', 'project', 'filename', 'label', 'size'])
+    >>> d.keys()
+    dict_keys(['filename', 'url', 'md5', 'sizeInBytes', 'parent_folder', 'label', 'size', 'timestamp', 'project', 'library'])
+    >>> d['filename'][0]
+    'README.txt'
+    >>> d['md5'][0].hex()
+    '9e590f803fa466f8fe381b835b1de90d'
+    >>> from io import BytesIO
+    >>> nested = BytesIO(b'<organismDirectory><folder name="A">'
+    ...                  b'<file filename="a1"/><folder name="B"><file filename="b1"/>'
+    ...                  b'</folder><file filename="a2"/></folder></organismDirectory>')
+    >>> links_from_xml(nested)['filename']
+    ['a1', 'a2']
     """
-    links = []
-    doc = ET.parse(xml)
-    root = doc.getroot()
-    for folder in root.iterfind("folder"):
-        for elem in folder.iterfind("file"):
-            elem.attrib["parent_folder"] = folder.get("name")
-            links.append(elem.attrib)
+    links = {column: [] for column in LINK_COLUMNS}
+    count = 0
+    for parent_folder, attrs in _iter_files(xml):
+        attrs["parent_folder"] = parent_folder
+        for key in attrs:
+            if key not in links:
+                links[key] = [""] * count
+        for key, column in links.items():
+            column.append(attrs.get(key, ""))
+        count += 1
+    links['md5'] = [_md5_bytes(md5) for md5 in links['md5']]
     return links
 
 
-def download_link(cookie, link_dict, output_dir=".", retries=5, overwrite=False):
-    """Builds and executes the download command. It will also create the file
-    output dir and parent folder it lies in on the Genome Portal.
+def _md5_bytes(hex_md5):
+    try:
+        return bytes.fromhex(hex_md5)
+    except ValueError:
+        logging.warn("Malformed md5, file will fail validation: %s", hex_md5)
+        return INVALID_MD5
+
+
+def _iter_files(xml):
+    # stream the document so memory doesn't grow with the number of files;
+    # each element is cleared once the caller has read its attributes
+    if lxml_etree is not None:
+        for _, folder in lxml_etree.iterparse(xml, events=("end",), tag="folder"):
+            parent = folder.getparent()
+            # nested folders are left to the top level folder holding them
+            if parent is None or parent.getparent() is not None:
+                continue
+            name = folder.get("name")
+            for elem in FOLDER_FILES(folder):
+                yield name, dict(elem.items())
+            folder.clear()
+            # the root still references the folders handled so far
+            while folder.getprevious() is not None:
+                del folder.getparent()[0]
+        return
+    # only files directly under a folder directly under the root are listed
+    depth = 0
+    current_folder = None
+    for event, elem in ET.iterparse(xml, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            if depth == 2 and elem.tag == "folder":
+                current_folder = elem.get("name")
+            continue
+        depth -= 1
+        if elem.tag == "file":
+            if depth == 2 and current_folder is not None:
+                yield current_folder, elem.attrib
+            elem.clear()
+        elif depth == 1 and elem.tag == "folder":
+            current_folder = None
+            elem.clear()
+
+
+def make_folders(parent_folders, output_dir="."):
+    """Creates the local dir for each unique Genome Portal parent folder.
 
     Args:
-        cookie (str): file path to cookie file
-        link_dict (dict): entry dictionary from :func:`links_from_xml`
+        parent_folders (list): parent folder column from :func:`links_from_xml`
         output_dir (Optional[str]): file path to dir in which to write
+
+    Returns:
+        dict of parent folder name to absolute local dir path
+    """
+    output_dir = os.path.abspath(output_dir)
+    folders = {}
+    for parent_folder in set(parent_folders):
+        if parent_folder:
+            folder_path = os.path.join(output_dir, parent_folder.replace(" ", "_"))
+        else:
+            folder_path = output_dir
+        os.makedirs(folder_path, exist_ok=True)
+        folders[parent_folder] = folder_path
+    return folders
+
+
+def download_link(cookie, links, folders, index, retries=5, overwrite=False):
+    """Builds and executes the download command.
+
+    Args:
+        cookie (str): file path to cookie file
+        links (dict): columns from :func:`links_from_xml`
+        folders (dict): local dirs from :func:`make_folders`
+        index (int): which file in `links` to download
         retries (Optional[int]): number of `curl` retries
         overwrite (Optional[boolean]): whether or not to overwrite existing local file
 
     Returns:
-        tuple of output file path, md5
+        tuple of output file path, remote md5, local md5, remote size; the
+        local md5 is computed while the file streams in, is None if nothing
+        was downloaded and DOWNLOAD_FAILED if every try failed
     """
-    if link_dict['parent_folder']:
-        output_dir = os.path.join(os.path.abspath(output_dir),
-                                  link_dict['parent_folder'].replace(" ", "_"))
+    filename = links['filename'][index]
+    remote_md5 = links['md5'][index]
+    remote_size = links['sizeInBytes'][index]
+    output_file = os.path.join(folders[links['parent_folder'][index]], filename)
+    if not overwrite and os.path.exists(output_file):
+        logging.debug("File exists: %s", output_file)
+        return (output_file, remote_md5, None, remote_size)
     else:
-        output_dir = os.path.join(os.path.abspath(output_dir))
-    os.makedirs(output_dir, exist_ok=True)
-    output_file = os.path.join(output_dir, link_dict['filename'])
-    if os.path.exists(output_file) and not overwrite:
-        logging.debug("File exists: %s" % output_file)
-        return (output_file, link_dict.get('md5', ''))
-    else:
-        logging.debug('Downloading %s.', link_dict['filename'])
-        cmd = ("curl 'http://genome.jgi.doe.gov{url}' -b {cookie} -s "
-               "--retry {retries} > {file}").format(url=link_dict['url'],
-               cookie=cookie, retries=retries, file=output_file)
+        logging.debug('Downloading %s.', filename)
+        cmd = ["curl", JGI_URL + links['url'][index], "-b", cookie, "-s",
+               "--retry", str(retries)]
+        tries = 0
+        while True:
+            hash_md5 = new_md5()
+            with open(output_file, "wb") as out:
+                p = sp.Popen(cmd, stdout=sp.PIPE)
+                for chunk in iter(lambda: p.stdout.read(MD5_BUFFER_SIZE), b""):
+                    hash_md5.update(chunk)
+                    out.write(chunk)
+                p.stdout.close()
+            if p.wait() == 0:
+                return (output_file, remote_md5, hash_md5.digest(), remote_size)
+            tries += 1
+            if tries > retries:
+                logging.warn("Failed to download %s: curl exited %d",
+                             output_file, p.returncode)
+                return (output_file, remote_md5, DOWNLOAD_FAILED, remote_size)
+            time.sleep(min(MAX_BACKOFF, 2 ** tries) * random.uniform(0.5, 1))
+
+
+def curl_version():
+    """Major and minor version of the local `curl`.
+
+    Returns:
+        tuple of ints, e.g. (7, 88)
+    """
+    out = sp.check_output(["curl", "--version"], universal_newlines=True)
+    m = re.match(r"curl (\d+)\.(\d+)", out)
+    if not m:
+        return (0, 0)
+    return (int(m.group(1)), int(m.group(2)))
+
+
+def _curl_quote(value):
+    # double-quoted curl config values interpret backslash escapes
+    return '"%s"' % value.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def parallel_download(links, cookie, output_dir=".", retries=5, overwrite=False,
+                      threads=12):
+    """Downloads all links with a single `curl --parallel` call so that
+    connections are reused across files. URL and output pairs are passed to
+    `curl` as a config on stdin.
+
+    Args:
+        links (dict): columns from :func:`links_from_xml`
+        cookie (str): file path to cookie
+        output_dir (Optional[str]): dir path where to write new files
+        retries (Optional[int]): number of `curl` retries
+        overwrite (Optional[boolean]): whether or not to overwrite existing local files
+        threads (Optional[int]): maximum number of simultaneous transfers
+
+    Yields:
+        local file path, remote md5, local md5, remote size tuples as each
+        file finishes.
+    """
+    folders = make_folders(links['parent_folder'], output_dir)
+    pending = {}
+    config = []
+    for index, parent_folder in enumerate(links['parent_folder']):
+        output_file = os.path.join(folders[parent_folder], links['filename'][index])
+        if not overwrite and os.path.exists(output_file):
+            logging.debug("File exists: %s", output_file)
+            yield (output_file, links['md5'][index], None,
+                   links['sizeInBytes'][index])
+            continue
+        pending[output_file] = (links['md5'][index], links['sizeInBytes'][index])
+        config.append(CURL_CONFIG_ENTRY.format(
+            url=_curl_quote(JGI_URL + links['url'][index]),
+            output=_curl_quote(output_file)))
+    if not pending:
+        return
+    cmd = ["curl", "-b", cookie, "-s", "--no-progress-meter", "--retry",
+           str(retries), "--parallel", "--parallel-max", str(threads),
+           "--write-out", "%{json}\n", "--config", "-"]
+    logging.debug(" ".join(cmd))
+    p = sp.Popen(cmd, stdin=sp.PIPE, stdout=sp.PIPE, universal_newlines=True)
+    # curl reads its whole config before writing any transfer results
+    p.stdin.write("".join(config))
+    p.stdin.close()
+    for line in p.stdout:
+        try:
+            transfer = json.loads(line)
+        except ValueError:
+            continue
+        output_file = transfer.get("filename_effective")
+        if output_file not in pending:
+            continue
+        if transfer.get("exitcode") or transfer.get("http_code", 0) >= 400:
+            logging.warn("Failed to download %s: %s", output_file,
+                         transfer.get("errormsg") or transfer.get("http_code"))
+        remote_md5, remote_size = pending.pop(output_file)
+        yield (output_file, remote_md5, None, remote_size)
+    p.wait()
+    for output_file in pending:
+        logging.warn("No transfer reported for %s", output_file)
+        remote_md5, remote_size = pending[output_file]
+        yield (output_file, remote_md5, None, remote_size)
+
+
+def load_cookies(cookie):
+    """Reads the cookie jar written by :func:`set_cookie`.
+
+    Args:
+        cookie (str): file path to cookie
+
+    Returns:
+        http.cookiejar.MozillaCookieJar
+    """
+    cookies = MozillaCookieJar(cookie)
+    cookies.load(ignore_discard=True, ignore_expires=True)
+    for c in cookies:
+        if c.expires == 0:
+            # session cookie as written by `curl` or :func:`set_cookie`
+            c.expires = None
+    return cookies
+
+
+async def _fetch(client, semaphore, links, folders, index, retries=5,
+                 overwrite=False):
+    filename = links['filename'][index]
+    remote_md5 = links['md5'][index]
+    remote_size = links['sizeInBytes'][index]
+    output_file = os.path.join(folders[links['parent_folder'][index]], filename)
+    if not overwrite and os.path.exists(output_file):
+        logging.debug("File exists: %s", output_file)
+        return (output_file, remote_md5, None, remote_size)
+    loop = asyncio.get_running_loop()
+    async with semaphore:
+        logging.debug('Downloading %s.', filename)
         tries = 0
         while True:
+            hash_md5 = new_md5()
             try:
-                sp.check_call(cmd, shell=True)
-                return (output_file, link_dict.get('md5', ''))
-            except sp.CalledProcessError:
+                async with client.stream("GET", JGI_URL + links['url'][index]) as resp:
+                    resp.raise_for_status()
+                    # disk writes and md5 release the GIL; running them in the
+                    # default executor keeps them off the event loop so files
+                    # are written and hashed in parallel
+                    out = await loop.run_in_executor(None, open, output_file, "wb")
+                    try:
+                        async for chunk in resp.aiter_bytes(MD5_BUFFER_SIZE):
+                            await loop.run_in_executor(None, _write_chunk, out,
+                                                       hash_md5, chunk)
+                    finally:
+                        out.close()
+                return (output_file, remote_md5, hash_md5.digest(), remote_size)
+            except (httpx.HTTPError, httpx.StreamError, OSError) as e:
+                # retried and reported per file rather than ending every transfer
+                logging.debug("Failed to download %s: %s", filename, e)
                 tries += 1
                 if tries > retries:
-                    return "", ""
-                time.sleep(tries * 10)
+                    logging.warn("Failed to download %s: %s", output_file, e)
+                    return (output_file, remote_md5, DOWNLOAD_FAILED, remote_size)
+                await asyncio.sleep(min(MAX_BACKOFF, 2 ** tries) *
+                                    random.uniform(0.5, 1))
+
 
+def _write_chunk(out, hash_md5, chunk):
+    hash_md5.update(chunk)
+    out.write(chunk)
+
+
+async def _http_download(links, cookies, folders, retries, overwrite, threads,
+                         results):
+    semaphore = asyncio.Semaphore(threads)
+    # HTTP/2 multiplexes transfers over one connection when `h2` is installed
+    http2 = importlib.util.find_spec("h2") is not None
+    limits = httpx.Limits(max_connections=threads)
+    timeout = httpx.Timeout(CONNECT_TIMEOUT, read=READ_TIMEOUT)
+    async with httpx.AsyncClient(cookies=cookies, http2=http2, limits=limits,
+                                 follow_redirects=True, timeout=timeout) as client:
+        tasks = [_fetch(client, semaphore, links, folders, index, retries, overwrite)
+                 for index in range(len(links['url']))]
+        for task in asyncio.as_completed(tasks):
+            results.put(await task)
+
+
+def http_download(links, cookie, output_dir=".", retries=5, overwrite=False,
+                  threads=12):
+    """Downloads all links in-process with `httpx`, sharing one connection
+    pool across files and hashing each file as it arrives.
+
+    Args:
+        links (dict): columns from :func:`links_from_xml`
+        cookie (str): file path to cookie
+        output_dir (Optional[str]): dir path where to write new files
+        retries (Optional[int]): number of retries per file
+        overwrite (Optional[boolean]): whether or not to overwrite existing local files
+        threads (Optional[int]): maximum number of simultaneous transfers
+
+    Returns:
+        iterator of local file path, remote md5, local md5, remote size tuples
+        in the order the files finish; the event loop runs in a background
+        thread
+    """
+    if httpx is None:
+        logging.critical("The httpx engine requires httpx: pip install 'gpd[httpx]'")
+        sys.exit(1)
+    cookies = load_cookies(cookie)
+    folders = make_folders(links['parent_folder'], output_dir)
+    results = queue.Queue()
+
+    def run():
+        try:
+            asyncio.run(_http_download(links, cookies, folders, retries,
+                                       overwrite, threads, results))
+        except BaseException as e:
+            results.put(e)
+        finally:
+            results.put(None)
+
+    threading.Thread(target=run, daemon=True).start()
+    return _drain(results)
+
+
+def _drain(results):
+    # re-raise failures of the background event loop in the consumer
+    for result in iter(results.get, None):
+        if isinstance(result, BaseException):
+            raise result
+        yield result
+
+
+def splice_link(cookie_header, links, folders, index, retries=5, overwrite=False):
+    """Downloads a file over plain HTTP, moving the body from the socket to
+    the output file with `os.splice` so it never passes through Python.
+
+    Args:
+        cookie_header (str): value for the Cookie request header
+        links (dict): columns from :func:`links_from_xml`
+        folders (dict): local dirs from :func:`make_folders`
+        index (int): which file in `links` to download
+        retries (Optional[int]): number of retries
+        overwrite (Optional[boolean]): whether or not to overwrite existing local file
 
-def handle_download(links, cookie, output_dir, retries, overwrite, threads):
+    Returns:
+        tuple of output file path, remote md5, None, remote size; the md5 is
+        left to validation as the data is never read. The local md5 slot is
+        DOWNLOAD_FAILED if every try failed or the server redirected.
+    """
+    filename = links['filename'][index]
+    remote_md5 = links['md5'][index]
+    remote_size = links['sizeInBytes'][index]
+    output_file = os.path.join(folders[links['parent_folder'][index]], filename)
+    if not overwrite and os.path.exists(output_file):
+        logging.debug("File exists: %s", output_file)
+        return (output_file, remote_md5, None, remote_size)
+    logging.debug('Downloading %s.', filename)
+    url = urlsplit(JGI_URL + links['url'][index])
+    path = url.path + ("?" + url.query if url.query else "")
+    tries = 0
+    while True:
+        conn = http.client.HTTPConnection(url.netloc, timeout=READ_TIMEOUT)
+        try:
+            conn.request("GET", path, headers={"Cookie": cookie_header})
+            # the connection lets go of its socket once a response will close
+            sock = conn.sock
+            resp = conn.getresponse()
+            if 300 <= resp.status < 400:
+                # retrying won't help and a move to https can't be spliced
+                logging.warn("Failed to download %s: redirected to %s, which "
+                             "the splice engine does not follow", output_file,
+                             resp.getheader("Location"))
+                return (output_file, remote_md5, DOWNLOAD_FAILED, remote_size)
+            if resp.status != 200:
+                raise http.client.HTTPException("HTTP %d" % resp.status)
+            with open(output_file, "wb") as out:
+                if resp.length is None:
+                    # chunked transfer encoding needs decoding in userspace
+                    shutil.copyfileobj(resp, out, MD5_BUFFER_SIZE)
+                else:
+                    _splice_body(sock, resp, out, resp.length)
+            return (output_file, remote_md5, None, remote_size)
+        except (OSError, http.client.HTTPException) as e:
+            logging.debug("Failed to download %s: %s", filename, e)
+            tries += 1
+            if tries > retries:
+                logging.warn("Failed to download %s: %s", output_file, e)
+                return (output_file, remote_md5, DOWNLOAD_FAILED, remote_size)
+            time.sleep(min(MAX_BACKOFF, 2 ** tries) * random.uniform(0.5, 1))
+        finally:
+            conn.close()
+
+
+def _splice_body(sock, resp, out, length):
+    if length == 0:
+        return
+    # http.client may already hold the start of the body in its buffer; peek
+    # without blocking so an empty buffer doesn't wait on the socket
+    timeout = sock.gettimeout()
+    sock.setblocking(False)
+    try:
+        head = resp.fp.read(min(length, len(resp.fp.peek())))
+    finally:
+        sock.settimeout(timeout)
+    out.write(head)
+    out.flush()
+    remaining = length - len(head)
+    sock_fd = sock.fileno()
+    # splice needs a pipe on one side: socket -> pipe -> file
+    r, w = os.pipe()
+    try:
+        try:
+            fcntl.fcntl(w, fcntl.F_SETPIPE_SZ, SPLICE_SIZE)
+        except (AttributeError, OSError):
+            pass
+        while remaining:
+            try:
+                n = os.splice(sock_fd, w, min(remaining, SPLICE_SIZE))
+            except BlockingIOError:
+                # sockets with a timeout are non-blocking at the OS level
+                if not select.select([sock_fd], [], [], timeout)[0]:
+                    raise socket.timeout("timed out")
+                continue
+            if n == 0:
+                raise http.client.IncompleteRead(b"", remaining)
+            remaining -= n
+            while n:
+                n -= os.splice(r, out.fileno(), n)
+    finally:
+        os.close(r)
+        os.close(w)
+
+
+def splice_download(links, cookie, output_dir=".", retries=5, overwrite=False,
+                    threads=12):
+    """Downloads links across threads with :func:`splice_link`. Only works
+    when the portal is reachable over plain HTTP, as TLS must be decrypted
+    in userspace.
+
+    Args:
+        links (dict): columns from :func:`links_from_xml`
+        cookie (str): file path to cookie
+        output_dir (Optional[str]): dir path where to write new files
+        retries (Optional[int]): number of retries per file
+        overwrite (Optional[boolean]): whether or not to overwrite existing local files
+        threads (Optional[int]): number of simultaneous downloads
+
+    Returns:
+        iterator of local file path, remote md5, local md5, remote size tuples
+        in the order the files finish
+    """
+    if not hasattr(os, "splice"):
+        logging.critical("The splice engine requires Linux and Python 3.10+.")
+        sys.exit(1)
+    cookie_header = "; ".join("%s=%s" % (c.name, c.value)
+                              for c in load_cookies(cookie))
+    folders = make_folders(links['parent_folder'], output_dir)
+    download = partial(splice_link, cookie_header, links, folders,
+                       retries=retries, overwrite=overwrite)
+    return _threaded_download(download, len(links['url']), threads)
+
+
+def handle_download(links, cookie, output_dir, retries, overwrite, threads,
+                    engine="curl-parallel"):
     """Downloads links across threads as simultaneous downloads.
 
     Args:
-        links (list): list of dict entries from :func:`links_from_xml`
+        links (dict): columns from :func:`links_from_xml`
         cookie (str): file path to cookie
         output_dir (str): dir path where to write new files
         retries (int): number of `curl` retries
         overwrite (boolean): whether or not to overwrite existing local files
         threads (int): number of simultaneous downloads
+        engine (Optional[str]): "curl-parallel" batches every link into
+            :func:`parallel_download` (falling back to one call per file for
+            `curl` older than 7.75); "curl" runs :func:`download_link` per
+            file, hashing each file as it arrives; "httpx" downloads
+            in-process with :func:`http_download`; "splice" uses
+            :func:`splice_download`
 
     Returns:
-        list of local file path, md5 tuples.
+        iterator of local file path, remote md5, local md5, remote size tuples
+        yielded as each download finishes.
     """
-    pool = multiprocessing.Pool(processes=threads)
-    download = partial(download_link, cookie, output_dir=output_dir,
-                       retries=retries, overwrite=overwrite)
-    download_results = pool.map(download, links)
-    pool.close()
-    pool.join()
-    return download_results
+    if engine == "httpx":
+        results = http_download(links, cookie, output_dir=output_dir,
+                                retries=retries, overwrite=overwrite,
+                                threads=threads)
+    elif engine == "splice":
+        results = splice_download(links, cookie, output_dir=output_dir,
+                                  retries=retries, overwrite=overwrite,
+                                  threads=threads)
+    elif engine == "curl-parallel" and curl_version() >= CURL_PARALLEL_VERSION:
+        results = parallel_download(links, cookie, output_dir=output_dir,
+                                    retries=retries, overwrite=overwrite,
+                                    threads=threads)
+    else:
+        if engine == "curl-parallel":
+            logging.debug("curl older than %d.%d; downloading one file per call.",
+                          *CURL_PARALLEL_VERSION)
+        folders = make_folders(links['parent_folder'], output_dir)
+        download = partial(download_link, cookie, links, folders, retries=retries,
+                           overwrite=overwrite)
+        results = _threaded_download(download, len(links['url']), threads)
+    return _count_downloads(results)
+
+
+def _threaded_download(download, count, threads):
+    # workers only wait on I/O, threads avoid forking an interpreter each
+    with ThreadPoolExecutor(max_workers=threads) as ex:
+        futures = [ex.submit(download, index) for index in range(count)]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def _count_downloads(results):
+    count = 0
+    for result in results:
+        count += 1
+        yield result
+    logging.info("Downloaded %d files.", count)
+
+
+def new_md5(data=b""):
+    """MD5 hash object from OpenSSL's optimized implementation, flagged as
+    an integrity check so FIPS-restricted builds still allow it.
+    """
+    try:
+        return hashlib.new("md5", data, usedforsecurity=False)
+    except TypeError:
+        # Python < 3.9
+        return hashlib.new("md5", data)
 
 
 def md5(fname):
-    # https://stackoverflow.com/questions/3431825/generating-an-md5-checksum-of-a-file
-    hash_md5 = hashlib.md5()
-    if not os.path.exists(fname):
+    try:
+        f = open(fname, "rb", buffering=0)
+    except FileNotFoundError:
         return None
-    with open(fname, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+    with f:
+        if hasattr(hashlib, "file_digest"):
+            # Python 3.11+; hashes in C and releases the GIL
+            return hashlib.file_digest(f, new_md5).digest()
+        hash_md5 = new_md5()
+        buf = memoryview(bytearray(MD5_BUFFER_SIZE))
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            hash_md5.update(buf[:n])
+    return hash_md5.digest()
+
 
+def _md5p8_stream(buf, stream, windows):
+    stride = MD5P8_STREAMS * MD5P8_BLOCK
+    h = new_md5()
+    for window in range(windows):
+        offset = window * MD5P8_ROWS * stride + stream * MD5P8_BLOCK
+        h.update(b"".join(MD5P8_GATHER.unpack_from(buf, offset)))
+    return h
 
-def check_md5(tpl):
-    """Run :func:`md5` against the local file and compare to known remote md5.
+
+def md5p8(fname):
+    """MD5P8 of a file: 64 byte blocks are interleaved across 8 MD5 streams
+    which are hashed concurrently and the 8 digests are hashed once more.
 
     Args:
-        tpl (tuple): file path, remote md5 string
+        fname (str): file path
+
+    Returns:
+        bytes: digest or None if the file does not exist
+    """
+    try:
+        f = open(fname, "rb")
+    except FileNotFoundError:
+        return None
+    window_size = MD5P8_ROWS * MD5P8_STREAMS * MD5P8_BLOCK
+    with f:
+        size = os.fstat(f.fileno()).st_size
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        try:
+            windows = size // window_size
+            with ThreadPoolExecutor(max_workers=MD5P8_STREAMS) as ex:
+                streams = list(ex.map(partial(_md5p8_stream, buf, windows=windows),
+                                      range(MD5P8_STREAMS)))
+            # the tail is less than one window, deal its blocks out directly
+            for i, offset in enumerate(range(windows * window_size, size,
+                                             MD5P8_BLOCK)):
+                streams[i % MD5P8_STREAMS].update(buf[offset:offset + MD5P8_BLOCK])
+        finally:
+            if size:
+                buf.close()
+    return new_md5(b"".join(h.digest() for h in streams)).digest()
+
+
+CHECKSUMS = {"md5": md5, "md5p8": md5p8}
+
+
+def check_md5(tpl, checksum="md5"):
+    """Run :func:`md5` (or :func:`md5p8`) against the local file and compare
+    to known remote md5.
+
+    Args:
+        tpl (tuple): file path, remote md5 digest, local md5 digest or None,
+            remote size; a local md5 hashed during download is compared
+            without re-reading, DOWNLOAD_FAILED always fails
+        checksum (Optional[str]): "md5" or "md5p8", how the remote md5 was made
 
     Returns:
         tuple of file path and test status
     """
-    path, remote_md5 = tpl
+    path, remote_md5, local_md5, _ = tpl
+    if remote_md5 == INVALID_MD5 or local_md5 == DOWNLOAD_FAILED:
+        return path, False
     # some files do not have md5 calculated
-    if remote_md5 and remote_md5 != md5(path):
+    if not remote_md5:
+        return path, True
+    if local_md5 is None or checksum != "md5":
+        local_md5 = CHECKSUMS[checksum](path)
+    if local_md5 is None or not hmac.compare_digest(remote_md5, local_md5):
         return path, False
     else:
         return path, True
 
 
-def validate_results(results, threads):
-    """Validates Genome Portal downloads.
+def check_size(tpl):
+    """Compare the local file size to the size listed in the XML. Catches
+    truncated downloads without reading the file.
 
     Args:
-        results (list): list of file, md5 strings
+        tpl (tuple): as for :func:`check_md5`
+
+    Returns:
+        tuple of file path and test status
+    """
+    path, _, _, remote_size = tpl
+    try:
+        return path, os.stat(path).st_size == int(remote_size)
+    except OSError:
+        return path, False
+
+
+def _verified_key(path, remote_md5, checksum):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns, remote_md5.hex(), checksum]
+
+
+def read_verified(cache_path):
+    """Reads the record of previously validated files.
+
+    Args:
+        cache_path (str): file path to JSON cache written by :func:`write_verified`
+
+    Returns:
+        dict of file path to [size, mtime_ns, remote md5, checksum]
+    """
+    try:
+        with open(cache_path) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_verified(cache_path, verified):
+    """Writes the record of validated files, replacing any previous one.
+
+    Args:
+        cache_path (str): file path to JSON cache
+        verified (dict): as returned by :func:`read_verified`
+    """
+    tmp = cache_path + ".tmp"
+    with open(tmp, "w") as fh:
+        json.dump(verified, fh)
+    os.replace(tmp, cache_path)
+
+
+def validate_results(results, threads, checksum="md5", cache_path=None,
+                     fast=False):
+    """Validates Genome Portal downloads. Each file is handed to a pool of
+    hashing processes as soon as its download finishes, so downloading and
+    hashing overlap. Files whose size, mtime and remote md5 match the
+    verification cache are not hashed again.
+
+    Args:
+        results (iterable): file, remote md5, local md5, remote size tuples,
+            e.g. from :func:`handle_download`
         threads (int): number of simultaneous md5 checks
+        checksum (Optional[str]): "md5" or "md5p8", see :func:`check_md5`
+        cache_path (Optional[str]): file path to verification cache
+        fast (Optional[boolean]): only compare sizes, see :func:`check_size`,
+            for files that were not hashed while downloading
 
     Returns:
         tuple of file path, test status
     """
-    pool = multiprocessing.Pool(processes=threads)
-    md5_results = pool.map(check_md5, results)
-    pool.close()
-    pool.join()
+    verified = read_verified(cache_path) if cache_path else {}
+    md5_results = []
+    checked = []
+    remote_md5s = {}
+    futures = []
+    size_only = 0
+    # download threads are already running; forking would copy their locks
+    ctx = multiprocessing.get_context("forkserver")
+    with ProcessPoolExecutor(max_workers=threads, mp_context=ctx) as ex:
+        for tpl in results:
+            path, remote_md5, local_md5, remote_size = tpl
+            if (local_md5 is None and remote_md5 and path in verified and
+                    verified[path] == _verified_key(path, remote_md5, checksum)):
+                logging.debug("Validated from cache: %s", path)
+                md5_results.append((path, True))
+                continue
+            if remote_md5 == INVALID_MD5 or local_md5 == DOWNLOAD_FAILED:
+                checked.append((path, False))
+                remote_md5s[path] = remote_md5
+                continue
+            if fast and local_md5 is None and remote_size.isdigit():
+                # not recorded in the cache; a full run still hashes these
+                md5_results.append(check_size(tpl))
+                size_only += 1
+                continue
+            remote_md5s[path] = remote_md5
+            if local_md5 is not None and checksum == "md5":
+                # hashed while downloading, nothing left to read
+                checked.append(check_md5(tpl, checksum))
+            else:
+                futures.append(ex.submit(check_md5, tpl, checksum))
+        checked.extend(future.result() for future in as_completed(futures))
+    for path, success in checked:
+        key = _verified_key(path, remote_md5s[path], checksum) if success else None
+        if key and remote_md5s[path]:
+            verified[path] = key
+        else:
+            verified.pop(path, None)
+    if cache_path:
+        write_verified(cache_path, verified)
+    md5_results.extend(checked)
+    if size_only:
+        logging.warn("Only file sizes were verified for %d files.", size_only)
     validated = 0
     failed_files = list()
     for path, success in md5_results:
@@ -211,15 +912,19 @@ def validate_results(results, threads):
             validated += 1
         else:
             failed_files.append(path)
-    logging.info("%d files validated." % validated)
+    logging.info("%d files validated.", validated)
     if failed_files:
-        logging.warn("%d files failed to download successfully." % len(failed_files))
+        logging.warn("%d files failed to download successfully.", len(failed_files))
         # thinking about making this cleanup optional
         for f in failed_files:
-            if os.path.exists(f):
+            try:
                 os.remove(f)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logging.warn("Could not delete %s: %s", f, e)
         logging.warn("These partial files have been deleted to facilitate re-download.")
-        logging.debug("Failed to download:\n %s" % "\n".join(failed_files))
+        logging.debug("Failed to download:\n %s", "\n".join(failed_files))
     return md5_results
 
 
@@ -233,7 +938,20 @@ def validate_results(results, threads):
               help="number of download retries if there is an error")
 @click.option("-t", "--threads", default=12, type=int, show_default=True,
               help="number of simultaneous download threads")
-def gpd(xml, configfile, output, overwrite, retries, threads):
+@click.option("--checksum", default="md5", type=click.Choice(sorted(CHECKSUMS)),
+              show_default=True,
+              help="how the remote md5 was calculated; md5p8 hashes 8 interleaved streams")
+@click.option("--fast-verify", is_flag=True, default=False,
+              help="check file sizes instead of md5 for files not hashed while downloading")
+@click.option("--engine", default="curl-parallel",
+              type=click.Choice(["curl-parallel", "curl", "httpx", "splice"]),
+              show_default=True,
+              help=("curl-parallel reuses connections in one curl process; "
+                    "curl runs one process per file and hashes while downloading; "
+                    "httpx downloads in-process (requires httpx); "
+                    "splice copies plain HTTP bodies in the kernel (Linux)"))
+def gpd(xml, configfile, output, overwrite, retries, threads, checksum,
+        fast_verify, engine):
     """Logs into JGI Genome Portal and downloads links from
     'Open Downloads as XML' XML file. Files are written into `output`/JGI
     folder name.
@@ -259,14 +977,15 @@ def gpd(xml, configfile, output, overwrite, retries, threads):
     os.makedirs(output, exist_ok=True)
     logging.info("Logging into http://genome.jgi.doe.gov")
     cookie = set_cookie(cfg['jgi.username'], cfg['jgi.password'], output)
-    logging.info("Parsing %s for URLs." % xml)
+    logging.info("Parsing %s for URLs.", xml)
     links = links_from_xml(xml)
-    logging.info("Found %s files to download." % len(links))
+    logging.info("Found %s files to download.", len(links['url']))
     logging.info("Downloading...")
     download_results = handle_download(links, cookie, output, retries,
-                                       overwrite, threads)
-    logging.info("Downloaded %d files." % len(download_results))
-    md5_results = validate_results(download_results, threads)
+                                       overwrite, threads, engine)
+    md5_results = validate_results(download_results, threads, checksum,
+                                   os.path.join(output, VERIFIED_CACHE),
+                                   fast_verify)
 
 
 if __name__ == '__main__':
@@ -13,7 +13,12 @@ setup(
     py_modules=['gpd'],
     install_requires=[
         'click',
+        'requests',
     ],
+    extras_require={
+        'httpx': ['httpx[http2]'],
+        'lxml': ['lxml'],
+    },
     entry_points='''
         [console_scripts]
         gpd=gpd:gpd